@@ -6,9 +6,11 @@ import socket
 import sys
 from contextlib import closing
 
+from dnstransport import DOH_PATH, DOH_PORT, DOT_PORT, DoHTransport, DoTTransport
 from pydns import DNSPacket
 
 DNS_CLIENT_VERSION = "0.2"
+DEFAULT_PORTS = {"udp": 53, "tls": DOT_PORT, "https": DOH_PORT}
 
 
 def cli_handle():
@@ -21,7 +23,22 @@ def cli_handle():
         "querytype", help="Specify type of query", nargs="?", type=int, default=1
     )
     parser.add_argument("-s", "--server", help="DNS server to query")
-    parser.add_argument("-p", "--port", help="DNS server port", type=int, default=53)
+    parser.add_argument(
+        "-p", "--port", help="DNS server port (default per transport)", type=int
+    )
+    parser.add_argument(
+        "-T",
+        "--transport",
+        help="transport to query over",
+        choices=sorted(DEFAULT_PORTS),
+        default="udp",
+    )
+    parser.add_argument(
+        "--tls-hostname", help="server name to verify the TLS certificate against"
+    )
+    parser.add_argument(
+        "--doh-path", help="URL path of the DoH endpoint", default=DOH_PATH
+    )
     parser.add_argument(
         "-t", "--timeout", help="response wait timeout", type=int, default=5
     )
@@ -108,6 +125,8 @@ def main():
         print("ERROR, did not recognize %s as a valid IP" % server_ip)
         sys.exit(2)
     dns_port = args.port
+    if dns_port is None:
+        dns_port = DEFAULT_PORTS[args.transport]
     timeout = args.timeout
     retries = args.retries
 
@@ -126,20 +145,54 @@ def main():
         print(q)
         print("### END Query Packet")
 
+    transport = None
+    if args.transport == "tls":
+        transport = DoTTransport(
+            server_ip, dns_port, server_hostname=args.tls_hostname, timeout=timeout
+        )
+    elif args.transport == "https":
+        transport = DoHTransport(
+            server_ip,
+            dns_port,
+            path=args.doh_path,
+            server_hostname=args.tls_hostname,
+            timeout=timeout,
+        )
+
     # Send the packet out and wait for response from server
-    for attempt in range(retries):
-        try:
-            reply = send_query(
-                server_family, socket.SOCK_DGRAM, q, timeout, server_ip, dns_port
-            )
-            break
-        except socket.timeout:
-            output_str = "Attempt %d/%d timed out," % (attempt + 1, retries)
-            if (attempt + 1) < retries:
-                print(" ".join([output_str, "retrying..."]))
-            else:
-                print(" ".join([output_str, "quitting"]))
-                sys.exit(3)
+    try:
+        for attempt in range(retries):
+            try:
+                if transport is None:
+                    reply = send_query(
+                        server_family,
+                        socket.SOCK_DGRAM,
+                        q,
+                        timeout,
+                        server_ip,
+                        dns_port,
+                    )
+                else:
+                    reply = transport.query(q)
+                break
+            except socket.timeout:
+                output_str = "Attempt %d/%d timed out," % (attempt + 1, retries)
+                if (attempt + 1) < retries:
+                    print(" ".join([output_str, "retrying..."]))
+                else:
+                    print(" ".join([output_str, "quitting"]))
+                    sys.exit(3)
+            except OSError as err:
+                if transport is None:
+                    raise
+                print("ERROR: %s query failed: %s" % (args.transport, err))
+                sys.exit(5)
+            except ValueError as err:
+                print("ERROR: bad reply from server: %s" % err)
+                sys.exit(4)
+    finally:
+        if transport is not None:
+            transport.close()
 
     if args.debug >= 2:
         print(b" ".join((bytes(len(reply)), reply)))
@@ -148,7 +201,10 @@ def main():
     # Parse the reply packet
     try:
         r = DNSPacket(reply)
-    except ValueError:
+    except ValueError as err:
+        if transport is not None:
+            print("ERROR: bad reply from server: %s" % err)
+            sys.exit(4)
         print("UDP packet truncated, retrying with TCP")
         reply = send_query(
             server_family, socket.SOCK_STREAM, q, timeout, server_ip, dns_port
@@ -0,0 +1,309 @@
+"""Module for sending DNS Packets over encrypted transports
+
+DNS-over-TLS (RFC 7858) and DNS-over-HTTPS (RFC 8484) both run over TLS
+connections held in a TLSConnectionPool. Connections stay open between
+queries and later handshakes resume the last TLS session, so only the first
+query to a server pays for a full handshake. Several queries can be
+pipelined on one connection, with each reply matched to its query by id.
+"""
+
+import socket
+import ssl
+import threading
+from struct import Struct
+
+from pydns import DNSHeader
+
+DOT_PORT = 853
+DOH_PORT = 443
+DOH_PATH = "/dns-query"
+DOH_MEDIA_TYPE = "application/dns-message"
+
+
+class TLSConnection:
+    """Class to hold a single TLS connection to a DNS server"""
+
+    def __init__(self, sock, key):
+        self.sock = sock
+        self.key = key
+        self.rfile = sock.makefile("rb")
+        self.closing = False
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout if timeout > 0 else None)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def read_exact(self, size):
+        data = self.rfile.read(size)
+        if len(data) != size:
+            raise ConnectionError("Connection closed by server")
+        return data
+
+    def read_line(self):
+        line = self.rfile.readline(65537)
+        if not line.endswith(b"\n"):
+            raise ConnectionError("Connection closed by server")
+        return line
+
+    def read_all(self):
+        self.closing = True
+        return self.rfile.read()
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class TLSConnectionPool:
+    """Class to keep idle TLS connections and sessions around for reuse"""
+
+    def __init__(self, context=None, max_idle=4):
+        if context is None:
+            context = ssl.create_default_context()
+        self.context = context
+        self.max_idle = max_idle
+        self._idle = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, server, port, server_hostname, timeout):
+        """Return (connection, reused), preferring an idle connection"""
+        key = (server, port, server_hostname)
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+            session = self._sessions.get(key)
+        if conn:
+            conn.settimeout(timeout)
+            return conn, True
+        sock = socket.create_connection(
+            (server, port), timeout if timeout > 0 else None
+        )
+        try:
+            tls = self.context.wrap_socket(
+                sock, server_hostname=server_hostname, session=session
+            )
+        except (OSError, ValueError):
+            sock.close()
+            raise
+        return TLSConnection(tls, key), False
+
+    def save_session(self, conn):
+        session = conn.sock.session
+        if session is not None:
+            self._sessions[conn.key] = session
+
+    def release(self, conn):
+        """Hand a healthy connection back to the pool"""
+        with self._lock:
+            self.save_session(conn)
+            idle = self._idle.setdefault(conn.key, [])
+            if not conn.closing and len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn):
+        """Close a failed connection, keeping its session for resumption"""
+        with self._lock:
+            self.save_session(conn)
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle_lists = list(self._idle.values())
+            self._idle = {}
+        for idle in idle_lists:
+            for conn in idle:
+                conn.close()
+
+
+class DNSTransport:
+    """Base class for DNS transports that pipeline over pooled TLS
+
+    Connections come from pool if given, otherwise from a new pool built on
+    context. Pass one or the other, since a pool already has its context.
+    """
+
+    default_port = None
+    alpn_protocols = None
+
+    def __init__(
+        self,
+        server,
+        port=None,
+        server_hostname=None,
+        timeout=5,
+        context=None,
+        pool=None,
+    ):
+        self.server = server
+        self.port = self.default_port if port is None else port
+        if server_hostname is None:
+            server_hostname = server
+        self.server_hostname = server_hostname
+        self.timeout = timeout
+        if pool is not None and context is not None:
+            raise ValueError("Pass either context or pool, not both")
+        if pool is None:
+            if context is None:
+                context = ssl.create_default_context()
+                if self.alpn_protocols:
+                    context.set_alpn_protocols(self.alpn_protocols)
+            pool = TLSConnectionPool(context)
+        self.pool = pool
+
+    def query(self, query):
+        """Send a single DNSPacket and return the raw reply"""
+        return self.query_many([query])[0]
+
+    def query_many(self, queries):
+        """Pipeline several DNSPackets and return raw replies in order"""
+        packs = [query.get_pack() for query in queries]
+        ids = [DNSHeader(pack).id for pack in packs]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Pipelined queries need unique ids")
+        pending = dict(zip(ids, packs))
+        replies = {}
+        while pending:
+            conn, reused = self.pool.acquire(
+                self.server, self.port, self.server_hostname, self.timeout
+            )
+            waiting = len(pending)
+            try:
+                self.exchange(conn, pending, replies)
+            except OSError as err:
+                self.pool.discard(conn)
+                # An idle connection may have been closed by the server, or
+                # the server may stop part way through a pipeline. Go again
+                # with whatever is unanswered on a fresh connection.
+                progress = len(pending) < waiting
+                if isinstance(err, socket.timeout) or not (reused or progress):
+                    raise
+                continue
+            except Exception:
+                self.pool.discard(conn)
+                raise
+            self.pool.release(conn)
+        return [replies[query_id] for query_id in ids]
+
+    def exchange(self, conn, pending, replies):
+        self.send_queries(conn, list(pending.values()))
+        while pending:
+            reply = self.read_reply(conn)
+            if len(reply) < DNSHeader.struct.size:
+                raise ValueError("Reply too short for a DNS header")
+            reply_id = DNSHeader(reply).id
+            if reply_id not in pending:
+                raise ValueError("Reply id %d does not match any query" % reply_id)
+            del pending[reply_id]
+            replies[reply_id] = reply
+
+    def send_queries(self, conn, packs):
+        raise NotImplementedError
+
+    def read_reply(self, conn):
+        raise NotImplementedError
+
+    def close(self):
+        self.pool.close()
+
+
+class DoTTransport(DNSTransport):
+    """Class to send DNS queries over TLS (RFC 7858)"""
+
+    default_port = DOT_PORT
+    length = Struct("!H")
+
+    def send_queries(self, conn, packs):
+        conn.sendall(b"".join(self.length.pack(len(pack)) + pack for pack in packs))
+
+    def read_reply(self, conn):
+        (size,) = self.length.unpack(conn.read_exact(self.length.size))
+        return conn.read_exact(size)
+
+
+class DoHTransport(DNSTransport):
+    """Class to send DNS queries over HTTPS (RFC 8484)
+
+    Requests are pipelined on a keep-alive HTTP/1.1 connection, so replies
+    come back in request order and are still checked against the query id.
+    """
+
+    default_port = DOH_PORT
+    alpn_protocols = ["http/1.1"]
+
+    def __init__(self, server, port=None, *args, path=DOH_PATH, **kwargs):
+        super().__init__(server, port, *args, **kwargs)
+        self.path = path
+
+    def host_header(self):
+        host = self.server_hostname
+        if ":" in host:
+            host = "[%s]" % host
+        if self.port != DOH_PORT:
+            host = "%s:%d" % (host, self.port)
+        return host
+
+    def send_queries(self, conn, packs):
+        retl = []
+        for pack in packs:
+            retl.append(
+                "\r\n".join(
+                    [
+                        "POST %s HTTP/1.1" % self.path,
+                        "Host: %s" % self.host_header(),
+                        "Accept: %s" % DOH_MEDIA_TYPE,
+                        "Content-Type: %s" % DOH_MEDIA_TYPE,
+                        "Content-Length: %d" % len(pack),
+                        "",
+                        "",
+                    ]
+                ).encode("ascii")
+            )
+            retl.append(pack)
+        conn.sendall(b"".join(retl))
+
+    def read_reply(self, conn):
+        status_line = conn.read_line().decode("latin-1").split(None, 2)
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+            raise ValueError("Malformed HTTP status line from DoH server")
+        version, status = status_line[0], int(status_line[1])
+        headers = {}
+        while True:
+            line = conn.read_line().decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        if connection == "close" or (
+            version == "HTTP/1.0" and connection != "keep-alive"
+        ):
+            conn.closing = True
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = self.read_chunked(conn)
+        elif "content-length" in headers:
+            body = conn.read_exact(int(headers["content-length"]))
+        else:
+            body = conn.read_all()
+
+        if status != 200:
+            raise ValueError("DoH server returned HTTP %d" % status)
+        return body
+
+    @staticmethod
+    def read_chunked(conn):
+        retl = []
+        while True:
+            size = int(conn.read_line().split(b";")[0], 16)
+            if not size:
+                break
+            retl.append(conn.read_exact(size))
+            conn.read_line()
+        while conn.read_line().strip():
+            pass  # discard trailers
+        return b"".join(retl)
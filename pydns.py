@@ -370,13 +370,18 @@ class DNSResource(DNSRaw):
 class DNSPacket(DNSRaw):
     """Class to represent a DNS packet, be it query or response"""
 
-    header = DNSHeader()
-    questions = []
-    answers = []
-    authority = []
-    additional = []
+    header = None
+    questions = None
+    answers = None
+    authority = None
+    additional = None
 
     def __init__(self, pack=None):
+        self.header = DNSHeader()
+        self.questions = []
+        self.answers = []
+        self.authority = []
+        self.additional = []
         if pack:
             self.from_pack(pack)
 
@@ -0,0 +1,336 @@
+"""Test set for dnstransport, run against local TLS stub servers"""
+
+import os.path
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import unittest
+from struct import Struct
+
+import dnstransport
+import pydns
+
+LENGTH = Struct("!H")
+ANSWER = Struct("!HHHLH")
+
+
+def make_reply(query):
+    """Answer every question in query with an A record of 127.0.0.1"""
+    header = pydns.DNSHeader(query)
+    header.notquery = True
+    header.RA = True
+    header.an_count = 1
+    answer = ANSWER.pack(0xC00C, 0x1, 0x1, 60, 4) + socket.inet_aton("127.0.0.1")
+    return b"".join([header.get_pack(), query[header.get_size() :], answer])
+
+
+class StubServer:
+    """Minimal TLS server that hands each connection to handle()"""
+
+    def __init__(self, context, batch=1, per_connection=None):
+        self.context = context
+        self.batch = batch
+        self.per_connection = per_connection
+        self.connections = []
+        self.requests = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.run, args=(sock,), daemon=True).start()
+
+    def run(self, sock):
+        try:
+            with self.context.wrap_socket(sock, server_side=True) as tls:
+                self.connections.append(tls.session_reused)
+                with tls.makefile("rb") as rfile:
+                    self.handle(tls, rfile)
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        self.listener.close()
+
+
+class DoTStub(StubServer):
+    """Answers each batch of queries in reverse order"""
+
+    def handle(self, tls, rfile):
+        answered = 0
+        while True:
+            queries = []
+            while len(queries) < self.batch:
+                size = rfile.read(LENGTH.size)
+                if len(size) != LENGTH.size:
+                    return
+                queries.append(rfile.read(LENGTH.unpack(size)[0]))
+            self.requests.extend(queries)
+            for query in reversed(queries):
+                reply = make_reply(query)
+                tls.sendall(LENGTH.pack(len(reply)) + reply)
+            answered += len(queries)
+            if self.per_connection and answered >= self.per_connection:
+                return
+
+
+class DoHStub(StubServer):
+    """Answers POSTed queries, picking the reply framing from the path"""
+
+    def handle(self, tls, rfile):
+        while True:
+            request_line = rfile.readline()
+            if not request_line:
+                return
+            headers = {}
+            for line in iter(rfile.readline, b"\r\n"):
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            query = rfile.read(int(headers["content-length"]))
+            path = request_line.split()[1]
+            self.requests.append((path, headers, query))
+            if path == b"/empty":
+                tls.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+                continue
+            reply = make_reply(query)
+            if path == b"/chunked":
+                half = len(reply) // 2
+                tls.sendall(
+                    b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                    b"%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n"
+                    % (half, reply[:half], len(reply) - half, reply[half:])
+                )
+                continue
+            if path == b"/close":
+                tls.sendall(
+                    b"HTTP/1.1 200 OK\r\nConnection: close\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (len(reply), reply)
+                )
+                return
+            if path == b"/http10":
+                tls.sendall(b"HTTP/1.0 200 OK\r\n\r\n%s" % reply)
+                return
+            if path != b"/dns-query":
+                tls.sendall(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+                continue
+            tls.sendall(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: application/dns-message\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(reply), reply)
+            )
+
+
+@unittest.skipUnless(shutil.which("openssl"), "openssl needed for test cert")
+class TLSTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.tmpdir, "cert.pem")
+        cls.key = os.path.join(cls.tmpdir, "key.pem")
+        subprocess.check_call(
+            [
+                "openssl", "req", "-x509", "-nodes", "-days", "1",
+                "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                "-keyout", cls.key, "-out", cls.cert, "-subj", "/CN=localhost",
+                "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )  # fmt: skip
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def server_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert, self.key)
+        return context
+
+    def client_context(self):
+        return ssl.create_default_context(cafile=self.cert)
+
+    def make_queries(self, count):
+        queries = []
+        for i in range(count):
+            query = pydns.DNSPacket()
+            query.add_q("host%d.example.com" % i)
+            queries.append(query)
+        return queries
+
+    def assert_answers(self, queries, replies):
+        self.assertEqual(len(queries), len(replies))
+        for query, reply in zip(queries, replies):
+            packet = pydns.DNSPacket(reply)
+            self.assertEqual(query.header.id, packet.header.id)
+            self.assertEqual(
+                str(query.questions[0].q_name), str(packet.questions[0].q_name)
+            )
+            self.assertIn("A: 127.0.0.1", packet.str_answers())
+
+
+class TestDoTTransport(TLSTestCase):
+    def test_connection_reuse(self):
+        stub = DoTStub(self.server_context())
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoTTransport(
+            "127.0.0.1", stub.port, context=self.client_context()
+        )
+        self.addCleanup(transport.close)
+        queries = self.make_queries(3)
+        replies = [transport.query(query) for query in queries]
+        self.assert_answers(queries, replies)
+        self.assertEqual(1, len(stub.connections))
+
+    def test_pipeline_out_of_order(self):
+        stub = DoTStub(self.server_context(), batch=4)
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoTTransport(
+            "127.0.0.1", stub.port, context=self.client_context()
+        )
+        self.addCleanup(transport.close)
+        queries = self.make_queries(4)
+        self.assert_answers(queries, transport.query_many(queries))
+        self.assertEqual(1, len(stub.connections))
+
+    def test_reconnect_resumes_session(self):
+        stub = DoTStub(self.server_context(), per_connection=1)
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoTTransport(
+            "127.0.0.1", stub.port, context=self.client_context()
+        )
+        self.addCleanup(transport.close)
+        queries = self.make_queries(2)
+        replies = [transport.query(query) for query in queries]
+        self.assert_answers(queries, replies)
+        self.assertEqual([False, True], stub.connections)
+
+    def test_pipeline_reconnect_resumes_session(self):
+        stub = DoTStub(self.server_context(), per_connection=2)
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoTTransport(
+            "127.0.0.1", stub.port, context=self.client_context()
+        )
+        self.addCleanup(transport.close)
+        queries = self.make_queries(5)
+        self.assert_answers(queries, transport.query_many(queries))
+        self.assertEqual([False, True, True], stub.connections)
+
+    def test_pool_max_idle(self):
+        stub = DoTStub(self.server_context())
+        self.addCleanup(stub.close)
+        pool = dnstransport.TLSConnectionPool(self.client_context(), max_idle=1)
+        self.addCleanup(pool.close)
+        key = ("127.0.0.1", stub.port, "127.0.0.1")
+        conn1, _ = pool.acquire(*key, timeout=5)
+        conn2, _ = pool.acquire(*key, timeout=5)
+        pool.release(conn1)
+        pool.release(conn2)
+        self.assertEqual([conn1], pool._idle[key])
+        self.assertEqual(-1, conn2.sock.fileno())
+
+    def test_context_and_pool(self):
+        with self.assertRaises(ValueError):
+            dnstransport.DoTTransport(
+                "127.0.0.1",
+                context=self.client_context(),
+                pool=dnstransport.TLSConnectionPool(self.client_context()),
+            )
+
+    def test_duplicate_ids(self):
+        queries = self.make_queries(2)
+        queries[1].header.id = queries[0].header.id
+        transport = dnstransport.DoTTransport("127.0.0.1", 1)
+        with self.assertRaises(ValueError):
+            transport.query_many(queries)
+
+    def test_untrusted_certificate(self):
+        stub = DoTStub(self.server_context())
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoTTransport("127.0.0.1", stub.port)
+        with self.assertRaises(ssl.SSLCertVerificationError):
+            transport.query(self.make_queries(1)[0])
+
+
+class TestDoHTransport(TLSTestCase):
+    def test_pipeline(self):
+        stub = DoHStub(self.server_context())
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoHTransport(
+            "127.0.0.1",
+            stub.port,
+            server_hostname="localhost",
+            context=self.client_context(),
+        )
+        self.addCleanup(transport.close)
+        queries = self.make_queries(3)
+        self.assert_answers(queries, transport.query_many(queries))
+        self.assert_answers(queries[:1], [transport.query(queries[0])])
+        self.assertEqual(1, len(stub.connections))
+        path, headers, _ = stub.requests[0]
+        self.assertEqual(b"/dns-query", path)
+        self.assertEqual("application/dns-message", headers["content-type"])
+        self.assertEqual("localhost:%d" % stub.port, headers["host"])
+
+    def query_path(self, path, count=2):
+        stub = DoHStub(self.server_context())
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoHTransport(
+            "127.0.0.1", stub.port, path=path, context=self.client_context()
+        )
+        self.addCleanup(transport.close)
+        queries = self.make_queries(count)
+        self.assert_answers(queries, [transport.query(query) for query in queries])
+        return stub
+
+    def test_chunked(self):
+        stub = self.query_path("/chunked")
+        self.assertEqual(1, len(stub.connections))
+
+    def test_connection_close(self):
+        stub = self.query_path("/close")
+        self.assertEqual(2, len(stub.connections))
+
+    def test_http10_read_until_close(self):
+        stub = self.query_path("/http10")
+        self.assertEqual(2, len(stub.connections))
+
+    def test_path_keyword_only(self):
+        transport = dnstransport.DoHTransport("127.0.0.1", 443, "dns.example")
+        self.assertEqual("dns.example", transport.server_hostname)
+        self.assertEqual(dnstransport.DOH_PATH, transport.path)
+
+    def test_http_error(self):
+        stub = DoHStub(self.server_context())
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoHTransport(
+            "127.0.0.1", stub.port, path="/missing", context=self.client_context()
+        )
+        self.addCleanup(transport.close)
+        with self.assertRaises(ValueError):
+            transport.query(self.make_queries(1)[0])
+
+    def test_short_reply(self):
+        stub = DoHStub(self.server_context())
+        self.addCleanup(stub.close)
+        transport = dnstransport.DoHTransport(
+            "127.0.0.1", stub.port, path="/empty", context=self.client_context()
+        )
+        self.addCleanup(transport.close)
+        with self.assertRaises(ValueError):
+            transport.query(self.make_queries(1)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
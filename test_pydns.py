@@ -12,6 +12,14 @@ class TestDNSPacket(unittest.TestCase):
         self.assertTrue(test_packet.header.RD)
         self.assertTrue(not test_packet.header.notquery)
 
+    def test_packets_independent(self):
+        packet1 = pydns.DNSPacket()
+        packet1.add_q("this.is.a.test.com")
+        packet2 = pydns.DNSPacket()
+        self.assertIsNot(packet1.header, packet2.header)
+        pydns.DNSPacket(packet1.get_pack())
+        self.assertEqual([], packet2.questions)
+
 
 class TestDNSName(unittest.TestCase):
     def test_name(self):